@@ -2,21 +2,35 @@ import os
 import time
 import asyncio
 import aiohttp
-import aiofiles
-import re  # Added for Aria2 regex
+import orjson
+import shutil
+import subprocess
+import secrets
+import socket
+import itertools
+from collections import Counter
+from dataclasses import dataclass
 from pyrogram import Client, filters
 from dotenv import load_dotenv
-from processor import process_video_task
-from utils import progress_bar
+from processor import process_video_task, close_tts_client
+from utils import new_progress, progress_updater, track_progress, humanbytes, SessionStore, BatchedFileWriter, SharedState, EditThrottle
 
 load_dotenv()
 
+# Faster libuv-based event loop when available; must be installed before the Client grabs a loop
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 app = Client(
     "video_editor_bot",
     api_id=int(os.getenv("API_ID")),
     api_hash=os.getenv("API_HASH"),
     bot_token=os.getenv("BOT_TOKEN"),
-    workers=4
+    workers=4,
+    max_concurrent_transmissions=4  # Allows the sharded Telegram download below
 )
 
 DOWNLOAD_DIR = "downloads"
@@ -27,39 +41,144 @@ for d in [DOWNLOAD_DIR, OUTPUT_DIR, TEMP_AUDIO]:
     os.makedirs(d, exist_ok=True)
 
 # --- GLOBAL QUEUE SYSTEM ---
-task_queue = asyncio.Queue()
-is_processing = False
-current_task_info = {} 
-
-user_sessions = {}
+# Entries are (priority, seq, task_data): admins jump the line, and every job a user
+# already has waiting pushes their next one back so one user can't monopolise the queue
+task_queue = asyncio.PriorityQueue()
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+_queue_seq = itertools.count()
+pending_per_user = Counter()
+
+async def enqueue_task(task_data):
+    uid = task_data['user_id']
+    priority = 0 if uid in ADMIN_IDS else 10 + pending_per_user[uid]
+    pending_per_user[uid] += 1
+    await task_queue.put((priority, next(_queue_seq), task_data))
+
+@dataclass
+class TaskInfo:
+    user_id: int
+    shared_state: SharedState
+    status_msg: object
+
+# Several workers so downloads/uploads overlap; downloads and the CPU-heavy processing step are capped separately
+N_WORKERS = int(os.getenv("WORKER_COUNT", "2"))
+_ffmpeg_sem = asyncio.Semaphore(int(os.getenv("FFMPEG_CONCURRENCY", "1")))
+# Download bulkhead: a burst of link jobs can't starve the encoder of disk/network bandwidth
+_download_sem = asyncio.Semaphore(int(os.getenv("DOWNLOAD_CONCURRENCY", "2")))
+
+# Running tasks by task_id; guarded by _state_lock so /stopall never races the worker's cleanup
+_state_lock = asyncio.Lock()
+_active_tasks = {}
+
+user_sessions = SessionStore(maxsize=1024)
 STATE_WAIT_JSON = 1
 STATE_WAIT_VIDEO = 2
 STATE_WAIT_NAME = 3
 STATE_QUEUED = 4
 
+SESSION_IDLE_TIMEOUT = 600  # Abandoned (not yet queued) sessions are dropped after 10 min
+
+WRITE_BATCH_SIZE = 8 * 1024 * 1024  # Fallback downloader flushes to disk every ~8MB
+
+# Aria2 is the primary downloader; resolved once so a missing binary skips straight to the fallback
+ARIA2_BIN = os.path.abspath("aria2c") if os.path.exists("aria2c") else shutil.which("aria2c")
+if not ARIA2_BIN: print("⚠️ aria2c not found, links will use the standard downloader.")
+
+def _aria2_max_connections():
+    # Stock aria2 rejects more than 16 connections per server; patched builds allow 32
+    if not ARIA2_BIN: return 16
+    try:
+        probe = subprocess.run([ARIA2_BIN, "--max-connection-per-server=32", "--version"], capture_output=True, timeout=10)
+        return 32 if probe.returncode == 0 else 16
+    except (OSError, subprocess.SubprocessError):
+        return 16
+
+ARIA2_CONNECTIONS = str(_aria2_max_connections())
+_BARS = tuple('█' * i + '░' * (10 - i) for i in range(11))
+ARIA2_STATUS_TMPL = (
+    "🚀 **Downloading (High Speed)...**\n[{bar}] {pct}%\n"
+    "**Completed**: {done} of {total}\n**Speed**: {speed}/s\n**Time:** {t}s"
+)
+ARIA2_STATUS_KEYS = ["status", "completedLength", "totalLength", "downloadSpeed", "errorMessage"]
+
+def _free_local_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def drain_tail(stream, keep=4096):
+    """
+    Reads a subprocess pipe in 64KB blocks until EOF so the child never blocks
+    on a full pipe; only the last `keep` bytes are kept for error reports.
+    """
+    tail = b''
+    while True:
+        block = await stream.read(64 * 1024)
+        if not block: return tail.decode(errors="ignore").strip()
+        tail = (tail + block)[-keep:]
+
+async def aria2_rpc(port, secret, method, *params):
+    payload = {"jsonrpc": "2.0", "id": "bot", "method": method, "params": [f"token:{secret}", *params]}
+    async with get_http_session().post(
+        f"http://127.0.0.1:{port}/jsonrpc", json=payload, timeout=aiohttp.ClientTimeout(total=5)
+    ) as response:
+        data = await response.json(content_type=None)
+    if "error" in data: raise RuntimeError(data["error"].get("message", "aria2 RPC error"))
+    return data["result"]
+
+# --- SHARED HTTP SESSION ---
+# One long-lived pool so repeat downloads reuse DNS + TLS connections
+_http_session = None
+
+def get_http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=75)
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            # No overall cap (videos are big) but a stalled socket fails after 60s;
+            # a bounded read buffer keeps the StreamReader from growing ahead of the disk
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=60),
+            read_bufsize=2 * 1024 * 1024
+        )
+    return _http_session
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
 # --- HELPER: Aria2 Downloader ---
 # Add this helper function ABOVE download_from_link
 async def download_fallback_slow(url, dest_path, status_msg, shared_state):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    print(f"❌ Fallback Download Failed: HTTP {response.status}")
-                    return False
-                
-                total = int(response.headers.get('content-length', 0))
-                downloaded = 0
-                start = time.time()
-                
-                async with aiofiles.open(dest_path, mode='wb') as f:
-                    async for chunk in response.content.iter_chunked(1024 * 1024):
-                        if shared_state.get('stop_signal', False): return False
+        session = get_http_session()
+        async with session.get(url, allow_redirects=True) as response:
+            if response.status != 200:
+                print(f"❌ Fallback Download Failed: HTTP {response.status}")
+                return False
+            
+            # The read loop only counts bytes; a background task edits the status
+            progress = new_progress(int(response.headers.get('content-length', 0)))
+            updater = asyncio.create_task(progress_updater(
+                progress, "⬇️ **Downloading (Slow Mode)...**", status_msg, time.time()
+            ))
+            
+            try:
+                # Chunks are copied into a recycled 8MB buffer pool and written one full buffer at a time
+                async with BatchedFileWriter(dest_path, WRITE_BATCH_SIZE, preallocate=progress['total']) as f:
+                    # iter_any() yields whatever the socket delivered, no re-buffering to a fixed size
+                    async for chunk in response.content.iter_any():
+                        if shared_state.stop_signal: return False
                         await f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        # Update progress bar
-                        if total > 0 and int(time.time()) % 4 == 0:
-                            await progress_bar(downloaded, total, "⬇️ **Downloading (Slow Mode)...**", start, status_msg)
+                        progress['done'] += len(chunk)
+                        progress['event'].set()
+            finally:
+                progress['finished'] = True
+                updater.cancel()
+
+            if progress['total'] and progress['done'] != progress['total']:
+                print(f"❌ Fallback Download Incomplete: {progress['done']}/{progress['total']} bytes")
+                return False
         return True
     except Exception as e:
         print(f"Fallback Error: {e}")
@@ -68,77 +187,91 @@ async def download_fallback_slow(url, dest_path, status_msg, shared_state):
 # Replace your existing download_from_link with this:
 async def download_from_link(url, dest_path, status_msg, shared_state):
     """
-    Tries High-Speed Aria2 first. If it fails, falls back to standard Python download.
+    Downloads with Aria2 (16-32 parallel connections). Falls back to the standard
+    Python download if the aria2c binary is missing or the transfer fails.
     """
     # 1. SETUP
     os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-    if os.path.exists(dest_path): os.remove(dest_path)
 
-    # Locate Aria2
-    aria2_path = os.path.abspath("aria2c")
-    if not os.path.exists(aria2_path): aria2_path = "aria2c"
+    if not ARIA2_BIN:
+        return await download_fallback_slow(url, dest_path, status_msg, shared_state)
 
     # 2. TRY ARIA2 (FAST)
+    # Progress comes from JSON-RPC polling (exact bytes/speed) instead of scraping stdout
     print(f"🚀 Trying Aria2 download for: {url}")
+    rpc_port = _free_local_port()
+    rpc_secret = secrets.token_hex(16)
+    gid = secrets.token_hex(8)  # We pick the GID so no addUri round trip is needed
     command = [
-        aria2_path, url,
+        ARIA2_BIN, url,
         "-o", os.path.basename(dest_path),
         "-d", os.path.dirname(dest_path),
-        "-x", "16", "-s", "16", "-k", "1M",
+        "-x", ARIA2_CONNECTIONS, "-s", ARIA2_CONNECTIONS, "-k", "2M",
+        "--file-allocation=falloc",  # Instant preallocation on ext4/xfs
+        "--max-tries=5", "--retry-wait=5",
+        "--disk-cache=64M",
+        "--async-dns=true",
         "--user-agent", "Mozilla/5.0",
         "--check-certificate=false", # Fix SSL errors
-        "--summary-interval", "1"
+        "--summary-interval=0",
+        "--console-log-level=warn",
+        "--allow-overwrite=true",  # Replaces a stale file instead of deleting it first
+        "--enable-rpc", "--rpc-listen-all=false",
+        f"--rpc-listen-port={rpc_port}", f"--rpc-secret={rpc_secret}",
+        f"--gid={gid}",
+        f"--stop-with-process={os.getpid()}"  # Never outlive the bot
     ]
 
+    process = None
     try:
-        # FIX: Increased buffer limit to 5MB
         process = await asyncio.create_subprocess_exec(
             *command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            limit=1024 * 1024 * 5  # 5MB Limit
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
         )
+        stderr_task = asyncio.create_task(drain_tail(process.stderr))
 
-        progress_pattern = re.compile(r"\((\d+)%\)")
         start_time = time.time()
         last_update_time = 0
+        status = {}
 
         while True:
-            if shared_state.get('stop_signal', False):
-                try: process.kill()
-                except: pass
-                return False
+            if shared_state.stop_signal: return False
+
+            # Sleeps 1s, but wakes immediately if aria2 exits on its own
+            try:
+                await asyncio.wait_for(process.wait(), timeout=1)
+                break
+            except asyncio.TimeoutError: pass
+
+            try: status = await aria2_rpc(rpc_port, rpc_secret, "aria2.tellStatus", gid, ARIA2_STATUS_KEYS)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError): continue  # RPC not up yet
+            if status["status"] in ("complete", "error", "removed"): break
 
-            line = await process.stdout.readline()
-            if not line: break
-            
-            decoded_line = line.decode().strip()
-            
             # Update Progress
-            match = progress_pattern.search(decoded_line)
-            if match:
-                percent = int(match.group(1))
-                now = time.time()
-                if now - last_update_time > 4:
-                    last_update_time = now
-                    filled = int(percent / 10)
-                    bar = f"[{'█' * filled}{'░' * (10 - filled)}] {percent}%"
-                    elapsed = int(now - start_time)
-                    try:
-                        await status_msg.edit(
-                            f"🚀 **Downloading (High Speed)...**\n{bar}\n**Time:** {elapsed}s"
-                        )
-                    except: pass
+            now = time.time()
+            total = int(status["totalLength"])
+            if total > 0 and now - last_update_time > 4:
+                last_update_time = now
+                done = int(status["completedLength"])
+                percent = done * 100 // total
+                try:
+                    await status_msg.edit(ARIA2_STATUS_TMPL.format(
+                        bar=_BARS[min(percent, 100) // 10], pct=percent,
+                        done=humanbytes(done), total=humanbytes(total),
+                        speed=humanbytes(int(status["downloadSpeed"])) or "0 B",
+                        t=int(now - start_time)
+                    ))
+                except: pass
 
-        await process.wait()
-        
         # 3. CHECK SUCCESS
-        if process.returncode == 0 and os.path.exists(dest_path):
+        if status.get("status") == "complete" and os.path.exists(dest_path):
             return True
         else:
             # Capture the error message
-            stderr_data = await process.stderr.read()
-            print(f"⚠️ Aria2 Failed (Code {process.returncode}). Error: {stderr_data.decode().strip()}")
+            await _stop_aria2(process, rpc_port, rpc_secret)
+            error = status.get("errorMessage") or await stderr_task
+            print(f"⚠️ Aria2 Failed (Code {process.returncode}). Error: {error}")
             
             # 4. ACTIVATE FALLBACK (SLOW)
             await status_msg.edit(f"⚠️ **High Speed failed. Switching to Standard Download...**")
@@ -146,37 +279,135 @@ async def download_from_link(url, dest_path, status_msg, shared_state):
 
     except Exception as e:
         print(f"Aria2 Exception: {e}")
+        if process is not None: await _stop_aria2(process, rpc_port, rpc_secret)
         return await download_fallback_slow(url, dest_path, status_msg, shared_state)
+
+    finally:
+        # RPC mode keeps aria2 alive after the download, so always shut it down
+        if process is not None: await _stop_aria2(process, rpc_port, rpc_secret)
+
+async def _stop_aria2(process, rpc_port, rpc_secret):
+    if process.returncode is not None: return
+    try: await aria2_rpc(rpc_port, rpc_secret, "aria2.forceShutdown")
+    except Exception: pass
+    try: await asyncio.wait_for(process.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
         
-async def clean_up(paths):
+# --- HELPER: Parallel Telegram Downloader ---
+TG_CHUNK_SIZE = 1024 * 1024  # stream_media offsets/limits are counted in 1MB chunks
+
+async def parallel_tg_download(message, dest_path, status_msg, shared_state, workers=4):
+    """
+    Splits the file into contiguous chunk ranges and fetches them concurrently
+    with stream_media, writing each piece in place with pwrite.
+    """
+    size = message.video.file_size
+    total_chunks = (size + TG_CHUNK_SIZE - 1) // TG_CHUNK_SIZE
+    per_worker = max(1, (total_chunks + workers - 1) // workers)
+    progress = new_progress(size)
+
+    fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        async def fetch_range(first_chunk, n_chunks):
+            cursor = first_chunk * TG_CHUNK_SIZE  # Private to this worker
+            async for chunk in app.stream_media(message, offset=first_chunk, limit=n_chunks):
+                if shared_state.stop_signal: raise Exception("⛔ Task Stopped")
+                os.pwrite(fd, chunk, cursor)
+                cursor += len(chunk)
+                progress['done'] += len(chunk)
+                progress['event'].set()
+
+        updater = asyncio.create_task(progress_updater(progress, "⬇️ **Downloading...**", status_msg, time.time()))
+        tasks = [
+            asyncio.create_task(fetch_range(first, min(per_worker, total_chunks - first)))
+            for first in range(0, total_chunks, per_worker)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except:
+            for t in tasks: t.cancel()
+            raise
+        finally:
+            progress['finished'] = True
+            updater.cancel()
+    finally:
+        os.close(fd)
+
+    if progress['done'] != size: raise Exception("Telegram download incomplete.")
+
+def prewarm_file(path):
+    """
+    Asks the kernel to start reading the file into the page cache so Pyrogram's
+    chunked reads during upload hit memory instead of disk. Linux only.
+    """
+    if not hasattr(os, "posix_fadvise"): return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try: os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally: os.close(fd)
+    except OSError: pass
+
+def _sync_cleanup(paths):
     for p in paths:
-        if p and os.path.exists(p):
-            try: os.remove(p)
-            except: pass
+        try: os.unlink(p)
+        except FileNotFoundError: pass
+        except OSError as e: print(f"⚠️ Cleanup failed for {p}: {e}")
+
+async def clean_up(paths):
+    await asyncio.to_thread(_sync_cleanup, [p for p in paths if p])
+
+_background_tasks = set()
+
+def clean_up_later(paths):
+    """Fire-and-forget cleanup so the worker can pick up the next job immediately."""
+    task = asyncio.create_task(clean_up(paths))
+    _background_tasks.add(task)  # Keep a strong ref until it finishes
+    task.add_done_callback(_background_tasks.discard)
+
+def release_session(uid, task_data):
+    """Frees the session that queued task_data; a newer session the user is still filling in stays."""
+    sess = user_sessions.get(uid)
+    if sess and sess["state"] == STATE_QUEUED and sess["data"] is task_data: user_sessions.pop(uid, None)
+
+async def sweep_sessions():
+    """Drops idle sessions that never reached the queue so their Message refs are freed."""
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.time() - SESSION_IDLE_TIMEOUT
+        stale = [
+            uid for uid, sess in user_sessions.items()
+            if sess["state"] != STATE_QUEUED and sess.get("updated", 0) < cutoff
+        ]
+        for uid in stale: user_sessions.pop(uid, None)
 
 # --- WORKER LOOP ---
-async def queue_worker():
-    global is_processing, current_task_info
-    print("👷 Worker started...")
+async def handle_task(task_data):
+    user_id = task_data['user_id']
+    chat_id = task_data['chat_id']
+    # Every status edit for this task goes through one throttle, so the download, processing
+    # and upload stages can't flood Telegram between them
+    status_msg = EditThrottle(task_data['status_msg'])
+    task_id = task_data['task_id']
+    # Per-task names: a deferred cleanup must never hit the next job's files.
+    # The task_id prefix keeps concurrent jobs with the same name apart; Telegram still sees the plain name
+    input_video_path = os.path.join(DOWNLOAD_DIR, f"{task_id}_input.mp4")
+    output_video_path = os.path.join(OUTPUT_DIR, f"{task_id}_{task_data['filename']}.mp4")
     
-    while True:
-        task_data = await task_queue.get()
-        is_processing = True
-        
-        user_id = task_data['user_id']
-        chat_id = task_data['chat_id']
-        status_msg = task_data['status_msg']
-        task_id = task_data['task_id']
-        
-        shared_state = {'stop_signal': False, 'text': '', 'percent': 0, 'current': 0, 'total': 0}
-        current_task_info = {'user_id': user_id, 'shared_state': shared_state, 'status_msg': status_msg}
+    shared_state = SharedState()
+    async with _state_lock:
+        _active_tasks[task_id] = TaskInfo(user_id, shared_state, status_msg)
 
-        try:
-            await status_msg.edit(f"🎬 **Starting Task!**\nQueue Position: 0 (Running)")
-            
-            # 1. Download
-            input_video_path = os.path.join(DOWNLOAD_DIR, f"{user_id}_input.mp4")
-            
+    try:
+        await status_msg.edit(f"🎬 **Starting Task!**\nQueue Position: 0 (Running)")
+        
+        # 1. Download
+        if _download_sem.locked():
+            await status_msg.edit("⏳ **Waiting for a free download slot...**")
+        async with _download_sem:
             if task_data["video_source"] == "link":
                 await status_msg.edit("⬇️ **Starting Download...**")
                 success = await download_from_link(task_data["video_link"], input_video_path, status_msg, shared_state)
@@ -184,79 +415,101 @@ async def queue_worker():
             
             elif task_data["video_source"] == "telegram":
                 await status_msg.edit("⬇️ **Downloading from Telegram...**")
-                await task_data["video_message"].download(
-                    file_name=input_video_path,
-                    progress=progress_bar,
-                    progress_args=("⬇️ **Downloading...**", time.time(), status_msg)
-                )
+                await parallel_tg_download(task_data["video_message"], input_video_path, status_msg, shared_state)
+                task_data.pop("video_message", None)  # Message objects are heavy, don't pin it any longer
 
-            if shared_state['stop_signal']: raise Exception("⛔ Task Stopped")
+        if shared_state.stop_signal: raise Exception("⛔ Task Stopped")
 
-            # 2. Process
-            output_video_path = os.path.join(OUTPUT_DIR, f"{task_data['filename']}.mp4")
-            
-            async def update_status_text(txt):
-                if not shared_state['stop_signal']:
-                    try: await status_msg.edit(f"⚙️ **Processing...**\n\n{txt}")
-                    except: pass
+        # 2. Process
+        async def update_status_text(txt):
+            if not shared_state.stop_signal:
+                await status_msg.edit(f"⚙️ **Processing...**\n\n{txt}")
 
+        if _ffmpeg_sem.locked():
+            await status_msg.edit("⏳ **Downloaded. Waiting for a free processing slot...**")
+        async with _ffmpeg_sem:
             await process_video_task(
                 input_video_path, 
-                task_data['json_path'], 
+                task_data.get('map', task_data['json_path']),
                 output_video_path, 
                 update_status_text,
                 shared_state,
                 task_id
             )
 
-            # 3. Upload
-            await status_msg.edit("⬆️ **Uploading Final Video...**")
+        # 3. Upload
+        await status_msg.edit("⬆️ **Uploading Final Video...**")
+        await asyncio.to_thread(prewarm_file, output_video_path)
+        # Pyrogram's per-part callback only records counters; edits come from the updater task
+        upload_progress = new_progress()
+        updater = asyncio.create_task(progress_updater(upload_progress, "⬆️ **Uploading...**", status_msg, time.time()))
+        try:
             await app.send_video(
                 chat_id=chat_id,
                 video=output_video_path,
+                file_name=f"{task_data['filename']}.mp4",
                 caption=f"✅ **{task_data['filename']}** is ready!",
-                progress=progress_bar,
-                progress_args=("⬆️ **Uploading...**", time.time(), status_msg)
+                progress=track_progress,
+                progress_args=(upload_progress,)
             )
-            await status_msg.delete()
-            
-            # Cleanup
-            await clean_up([task_data['json_path'], input_video_path, output_video_path])
-
-        except Exception as e:
-            msg = str(e)
-            if "Stopped" in msg:
-                await status_msg.edit("🛑 **Process Stopped by Admin.**")
-            else:
-                await status_msg.edit(f"❌ **Error:** {msg}")
-                print(f"Task Error: {msg}")
-            
-            try:
-                paths = [task_data.get('json_path'), os.path.join(DOWNLOAD_DIR, f"{user_id}_input.mp4")]
-                await clean_up(paths)
-            except: pass
-            
         finally:
-            is_processing = False
-            current_task_info = {}
-            task_queue.task_done()
-            user_sessions.pop(user_id, None)
+            upload_progress['finished'] = True
+            updater.cancel()
+        await status_msg.delete()
+        
+        # Cleanup
+        clean_up_later([task_data['json_path'], input_video_path, output_video_path])
+
+    except Exception as e:
+        msg = str(e)
+        if "Stopped" in msg:
+            await status_msg.edit("🛑 **Process Stopped by Admin.**", now=True)
+        else:
+            await status_msg.edit(f"❌ **Error:** {msg}", now=True)
+            print(f"Task Error: {msg}")
+        
+        # A stopped or failed encode leaves a partial output behind; nothing else would ever remove it
+        clean_up_later([task_data.get('json_path'), input_video_path, output_video_path])
+        
+    finally:
+        async with _state_lock:
+            _active_tasks.pop(task_id, None)
+        pending_per_user[user_id] -= 1
+        if pending_per_user[user_id] <= 0: del pending_per_user[user_id]
+        release_session(user_id, task_data)
+
+async def queue_worker(worker_id=0):
+    print(f"👷 Worker {worker_id} started...")
+    
+    while True:
+        _priority, _seq, task_data = await task_queue.get()
+        # handle_task reports its own errors; anything escaping it must not take the worker down
+        try: await handle_task(task_data)
+        except Exception as e: print(f"⚠️ Worker {worker_id} error: {e!r}")
+        finally: task_queue.task_done()
 
 # --- COMMANDS ---
 
 @app.on_message(filters.command("stopall"))
 async def stop_all(client, message):
-    global is_processing, current_task_info
-    
     q_size = task_queue.qsize()
     while not task_queue.empty():
-        try: task_queue.get_nowait()
+        try: _, _, dropped = task_queue.get_nowait()
         except: break
+        uid = dropped['user_id']
+        pending_per_user[uid] -= 1
+        if pending_per_user[uid] <= 0: del pending_per_user[uid]
+        # handle_task never runs for a dropped job, so its queued session (and video_message) goes here
+        release_session(uid, dropped)
     
     msg = f"🛑 **Stopping Everything...**\nDeleted {q_size} queued tasks."
     
-    if is_processing and current_task_info:
-        current_task_info['shared_state']['stop_signal'] = True
+    async with _state_lock:
+        for info in _active_tasks.values():
+            info.shared_state.stop_signal = True
+        stopped = len(_active_tasks)
+
+    if stopped:
         msg += "\nSent STOP signal to current process."
     else:
         msg += "\nNo active process found."
@@ -265,74 +518,94 @@ async def stop_all(client, message):
 
 @app.on_message(filters.command("start"))
 async def start(client, message):
-    user_sessions[message.from_user.id] = {"state": STATE_WAIT_JSON, "data": {}}
+    user_sessions[message.from_user.id] = {"state": STATE_WAIT_JSON, "data": {}, "updated": time.time()}
     await message.reply_text("👋 **Welcome!**\nStep 1: Send `map.json` file.")
 
-@app.on_message(filters.document)
-async def handle_doc(client, message):
-    uid = message.from_user.id
-    sess = user_sessions.get(uid)
-    if not sess: return
+# --- CONVERSATION STEPS ---
 
-    if sess["state"] == STATE_WAIT_JSON:
-        if not message.document.file_name.endswith(".json"):
-            await message.reply_text("❌ Send a valid .json file.")
-            return
-        
-        status = await message.reply_text("📥 Saving Map...")
-        
-        # FIX: Add timestamp to make filename UNIQUE for every single task
-        # This prevents "Episode 2" from overwriting "Episode 1"
-        timestamp = int(time.time())
-        task_id = f"{uid}_{timestamp}"
-        unique_filename = f"{uid}_{timestamp}_map.json"
-        path = os.path.join(DOWNLOAD_DIR, unique_filename)
-        
-        await message.download(file_name=path)
-        
-        sess["data"]["json_path"] = path
-        sess["data"]["task_id"] = task_id
-        sess["state"] = STATE_WAIT_VIDEO
-        await status.edit("✅ **Map Saved!**\nStep 2: Send Video or Link.")
+async def _handle_json(message, sess, uid):
+    if not message.document: return
+    if not message.document.file_name.endswith(".json"):
+        await message.reply_text("❌ Send a valid .json file.")
+        return
+    
+    status = await message.reply_text("📥 Saving Map...")
+    
+    # FIX: Add timestamp to make filename UNIQUE for every single task
+    # This prevents "Episode 2" from overwriting "Episode 1"
+    timestamp = int(time.time())
+    task_id = f"{uid}_{timestamp}"
+    unique_filename = f"{uid}_{timestamp}_map.json"
+    path = os.path.join(DOWNLOAD_DIR, unique_filename)
+    
+    await message.download(file_name=path)
+
+    # Parse once here so processing doesn't re-read the file; broken JSON is left to the healer
+    try:
+        with open(path, 'rb') as f: sess["data"]["map"] = orjson.loads(f.read())
+    except orjson.JSONDecodeError: pass
+    
+    sess["data"]["json_path"] = path
+    sess["data"]["task_id"] = task_id
+    sess["state"] = STATE_WAIT_VIDEO
+    await status.edit("✅ **Map Saved!**\nStep 2: Send Video or Link.")
+
+async def _handle_video_step(message, sess, uid):
+    if message.video:
+        sess["data"]["video_source"] = "telegram"
+        sess["data"]["video_message"] = message
+        sess["state"] = STATE_WAIT_NAME
+        await message.reply_text("✅ Video Received!\nStep 3: Send Output Name.")
+    elif message.text and message.text.startswith("http"):
+        sess["data"]["video_source"] = "link"
+        sess["data"]["video_link"] = message.text
+        sess["state"] = STATE_WAIT_NAME
+        await message.reply_text("✅ Link Received!\nStep 3: Send Output Name.")
+    else:
+        await message.reply_text("❌ Invalid. Send Video or Link.")
+
+async def _handle_name(message, sess, uid):
+    if not message.text: return
+    name = message.text.strip().replace(" ", "_")
+    sess["data"]["filename"] = name
+    sess["data"]["user_id"] = uid
+    sess["data"]["chat_id"] = message.chat.id
+    
+    status_msg = await message.reply_text("⏳ **Adding to Queue...**")
+    sess["data"]["status_msg"] = status_msg
+    
+    await enqueue_task(sess["data"])
+    
+    q_pos = task_queue.qsize()
+    await status_msg.edit(f"✅ **Added to Queue!**\nPosition: #{q_pos}\nWaiting for worker...")
+    
+    sess["state"] = STATE_QUEUED
+
+STEP_HANDLERS = {
+    STATE_WAIT_JSON: _handle_json,
+    STATE_WAIT_VIDEO: _handle_video_step,
+    STATE_WAIT_NAME: _handle_name,
+}
 
-@app.on_message(filters.video | filters.text)
-async def handle_input(client, message):
+@app.on_message(filters.document | filters.video | filters.text)
+async def handle_message(client, message):
     uid = message.from_user.id
     sess = user_sessions.get(uid)
     if not sess: return
 
-    if sess["state"] == STATE_WAIT_VIDEO:
-        if message.video:
-            sess["data"]["video_source"] = "telegram"
-            sess["data"]["video_message"] = message
-            sess["state"] = STATE_WAIT_NAME
-            await message.reply_text("✅ Video Received!\nStep 3: Send Output Name.")
-        elif message.text and message.text.startswith("http"):
-            sess["data"]["video_source"] = "link"
-            sess["data"]["video_link"] = message.text
-            sess["state"] = STATE_WAIT_NAME
-            await message.reply_text("✅ Link Received!\nStep 3: Send Output Name.")
-        else:
-            await message.reply_text("❌ Invalid. Send Video or Link.")
-
-    elif sess["state"] == STATE_WAIT_NAME:
-        name = message.text.strip().replace(" ", "_")
-        sess["data"]["filename"] = name
-        sess["data"]["user_id"] = uid
-        sess["data"]["chat_id"] = message.chat.id
-        
-        status_msg = await message.reply_text("⏳ **Adding to Queue...**")
-        sess["data"]["status_msg"] = status_msg
-        
-        await task_queue.put(sess["data"])
-        
-        q_pos = task_queue.qsize()
-        await status_msg.edit(f"✅ **Added to Queue!**\nPosition: #{q_pos}\nWaiting for worker...")
-        
-        sess["state"] = STATE_QUEUED
+    step = STEP_HANDLERS.get(sess["state"])
+    if not step: return
+    sess["updated"] = time.time()
+    await step(message, sess, uid)
 
 if __name__ == "__main__":
     print("🤖 Bot Started...")
     loop = asyncio.get_event_loop()
-    loop.create_task(queue_worker())
-    app.run()
+    print(f"🔁 Event loop: {loop.__class__.__name__}")
+    for i in range(N_WORKERS):
+        loop.create_task(queue_worker(i))
+    loop.create_task(sweep_sessions())
+    try: app.run()
+    finally:
+        loop.run_until_complete(close_http_session())
+        loop.run_until_complete(close_tts_client())
@@ -1,37 +1,20 @@
 import os
-import json
+import orjson
 import base64
-import requests
 import asyncio
+import httpx
 import re
-import gc
 import shutil
+import subprocess
 import time
-from proglog import ProgressBarLogger
-from moviepy import VideoFileClip, AudioFileClip, concatenate_videoclips, vfx
+import wave
+import random
+import math
 from dotenv import load_dotenv
 
 load_dotenv()
 SARVAM_API_KEY = os.getenv("SARVAM_API_KEY")
 
-# --- LOGGER ---
-class TelegramLogger(ProgressBarLogger):
-    def __init__(self, shared_state, batch_index, total_batches):
-        super().__init__()
-        self.shared_state = shared_state
-        self.batch_info = f"Batch {batch_index}/{total_batches}"
-
-    def callback(self, **changes):
-        if self.shared_state.get('stop_signal', False): raise Exception("⛔ Task Stopped")
-        for (parameter, value) in changes.items():
-            if parameter == 'bars' and 't' in value:
-                total = value['t']['total']
-                index = value['t']['index']
-                if total > 0:
-                    percent = int((index / total) * 100)
-                    self.shared_state['text'] = f"🎞️ **Rendering {self.batch_info}...**"
-                    self.shared_state['percent'] = percent
-
 def make_progress_bar(current, total):
     if total == 0: return "[░░░░░░░░░░] 0%"
     percentage = min(current * 100 / total, 100)
@@ -41,65 +24,60 @@ def make_progress_bar(current, total):
 def time_formatter(seconds):
     return time.strftime("%H:%M:%S", time.gmtime(seconds))
 
-async def run_ffmpeg_with_progress(command, total_duration, status_callback):
+async def run_ffmpeg_with_progress(command, total_duration, status_callback, shared_state=None):
     """
-    Runs FFmpeg and parses stderr to show Size, Speed, ETA.
+    Runs FFmpeg with `-progress pipe:1` and turns its key=value blocks into
+    Speed / ETA updates. Kills it early once shared_state.stop_signal is set.
     """
-    # FIX: Increased buffer limit to 5MB to prevent "Separator not found" crash
+    command = [command[0], "-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:1", *command[1:]]
     process = await asyncio.create_subprocess_exec(
         *command, 
         stdout=asyncio.subprocess.PIPE, 
-        stderr=asyncio.subprocess.PIPE,
-        limit=1024 * 1024 * 5  # 5MB Limit (Fixes the crash)
+        stderr=asyncio.subprocess.PIPE
     )
+    # Only errors reach stderr now; read it alongside so the pipe can never fill up
+    errors = asyncio.create_task(process.stderr.read())
     
-    # Regex to extract: time=00:01:23.45 bitrate=1234kbits/s speed=1.5x
-    pattern = re.compile(r"time=(\d{2}:\d{2}:\d{2}\.\d+).*?speed=\s*(\d+\.?\d*)x")
-    
-    start_time = time.time()
     last_update = 0
+    curr_seconds = 0.0
+    speed = 0.0
 
-    while True:
-        # Read line by line from stderr (where ffmpeg prints logs)
-        line_bytes = await process.stderr.readline()
-        if not line_bytes: break
-        
-        line = line_bytes.decode('utf-8', errors='ignore').strip()
-        
-        match = pattern.search(line)
-        if match:
-            current_time_str = match.group(1)
-            speed_str = match.group(2)
-            
-            try:
-                # Convert "00:01:23.45" to seconds
-                curr_seconds = parse_time(current_time_str)
-                speed = float(speed_str)
+    async for line_bytes in process.stdout:
+        if shared_state and shared_state.stop_signal:
+            process.kill()
+            await process.wait()
+            errors.cancel()
+            raise Exception("Stop")
+
+        key, _, value = line_bytes.decode('utf-8', errors='ignore').strip().partition('=')
+        if key in ("out_time_us", "out_time_ms"):  # Both are microseconds
+            try: curr_seconds = int(value) / 1_000_000
+            except ValueError: pass
+        elif key == "speed":
+            try: speed = float(value.rstrip('x'))
+            except ValueError: pass  # "N/A" until the first frames are out
+        elif key == "progress" and total_duration > 0 and speed > 0:
+            # Closes one progress block (~every 0.5s); Telegram gets at most one edit per 4s
+            now = time.time()
+            if now - last_update > 4:
+                last_update = now
+                percent = min((curr_seconds / total_duration) * 100, 99)
+                eta = max(total_duration - curr_seconds, 0) / speed
                 
-                if total_duration > 0 and speed > 0:
-                    percent = min((curr_seconds / total_duration) * 100, 99)
-                    
-                    # Calculate ETA
-                    remaining_seconds = total_duration - curr_seconds
-                    eta = remaining_seconds / speed
-                    
-                    # Update Telegram every 4 seconds
-                    now = time.time()
-                    if now - last_update > 4:
-                        last_update = now
-                        
-                        bar = make_progress_bar(percent, 100)
-                        status_text = (
-                            f"🚀 **Final Compression (x265)**\n"
-                            f"{bar} **{int(percent)}%**\n\n"
-                            f"⚡ **Speed:** {speed}x\n"
-                            f"⏳ **ETA:** {time_formatter(eta)}\n"
-                            f"🕒 **Time:** {time_formatter(curr_seconds)}"
-                        )
-                        await status_callback(status_text)
-            except: pass
+                bar = make_progress_bar(percent, 100)
+                status_text = (
+                    f"🚀 **Final Compression (HEVC)**\n"
+                    f"{bar} **{int(percent)}%**\n\n"
+                    f"⚡ **Speed:** {speed}x\n"
+                    f"⏳ **ETA:** {time_formatter(eta)}\n"
+                    f"🕒 **Time:** {time_formatter(curr_seconds)}"
+                )
+                await status_callback(status_text)
 
     await process.wait()
+    stderr = await errors
+    if process.returncode != 0:
+        raise Exception(f"FFmpeg failed: {stderr.decode('utf-8', errors='ignore').strip()[-300:]}")
 
 def parse_time(time_str):
     try:
@@ -109,102 +87,367 @@ def parse_time(time_str):
     except: return 0
     return 0
 
-def generate_audio_sync(text, filename):
-    if not text or not text.strip(): return False
-    try:
-        response = requests.post(
-            "https://api.sarvam.ai/text-to-speech",
-            json={"text": text, "target_language_code": "hi-IN", "speaker": "shubh", "model": "bulbul:v3-beta"},
-            headers={"api-subscription-key": SARVAM_API_KEY}
+# --- TTS ---
+TTS_URL = "https://api.sarvam.ai/text-to-speech"
+TTS_CONCURRENCY = 8
+TTS_MAX_ATTEMPTS = 4
+TTS_RETRY_STATUSES = {429, 500, 502, 503, 504}  # Anything else (400/401/403...) won't fix itself
+TTS_TIMEOUT = httpx.Timeout(20, connect=5)  # A hung request can't stall the whole task
+
+class TTSError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive upstream failures. While open, calls fail
+    fast instead of waiting on a dead API; after `cooldown` seconds calls are let
+    through again and the first success closes it.
+    """
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.fails = 0
+        self.opened_at = 0
+
+    def allow(self):
+        return self.fails < self.threshold or time.time() - self.opened_at >= self.cooldown
+
+    def record_success(self):
+        self.fails = 0
+
+    def record_failure(self):
+        self.fails += 1
+        if self.fails >= self.threshold: self.opened_at = time.time()
+
+    async def call(self, func, *args):
+        if not self.allow(): raise TTSError("Circuit open, Sarvam API is failing")
+        try: result = await func(*args)
+        except TTSError as e:
+            # Only upstream trouble counts; a rejected request says nothing about API health
+            if e.status is None or e.status in TTS_RETRY_STATUSES: self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+# Shared by all tasks: the upstream is the same for everyone
+_tts_breaker = CircuitBreaker()
+
+# One HTTP/2 client for the bot's lifetime, so consecutive jobs reuse the warm TLS connection
+_tts_client = None
+
+def get_tts_client():
+    global _tts_client
+    if _tts_client is None or _tts_client.is_closed:
+        _tts_client = httpx.AsyncClient(
+            http2=True,
+            headers={"api-subscription-key": SARVAM_API_KEY},
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            timeout=TTS_TIMEOUT
         )
-        if response.status_code == 200:
-            with open(filename, "wb") as f:
-                f.write(base64.b64decode(response.json()["audios"][0]))
-            return True
-    except: pass
-    return False
+    return _tts_client
+
+async def close_tts_client():
+    if _tts_client is not None and not _tts_client.is_closed:
+        await _tts_client.aclose()
+
+def _save_audio(body, filename):
+    # The TTS endpoint answers with base64 WAV inside JSON; orjson parses the raw bytes
+    # without first decoding the whole body to str like response.json() does
+    audio = base64.b64decode(orjson.loads(body)["audios"][0])
+    with open(filename, "wb") as f: f.write(audio)
+
+async def generate_audio(client, text, filename):
+    """
+    Writes the narration for one segment. Transient failures are retried with
+    exponential backoff + full jitter; raises TTSError once it gives up.
+    """
+    if not text or not text.strip(): return False
+
+    for attempt in range(TTS_MAX_ATTEMPTS):
+        try:
+            response = await client.post(
+                TTS_URL,
+                json={"text": text, "target_language_code": "hi-IN", "speaker": "shubh", "model": "bulbul:v3-beta"}
+            )
+        except httpx.TransportError as e:  # Connection errors and timeouts
+            error = TTSError(f"Network error: {e!r}")
+        else:
+            if response.status_code == 200:
+                # Multi-MB body: parsing, decoding and writing it would stall every other segment's request
+                try: await asyncio.to_thread(_save_audio, response.content, filename)
+                except (ValueError, KeyError, IndexError, TypeError) as e: raise TTSError(f"Bad response body: {e!r}", 200)
+                return True
+            error = TTSError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+            if response.status_code not in TTS_RETRY_STATUSES: raise error
+
+        if attempt < TTS_MAX_ATTEMPTS - 1:
+            await asyncio.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt)))
+    raise error
+
+# Auto-heal helpers, built once: control bytes -> spaces via a 256-byte table, plus the
+# explanation_text quote fixer (bytes pattern, so the map never needs decoding)
+_CONTROL_TABLE = bytes(32 if c < 32 or c == 127 else c for c in range(256))
+_EXPL_RE = re.compile(rb'("explanation_text"\s*:\s*")(.*?)("\s*[,}])', re.DOTALL)
 
 def load_and_heal_json(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f: content = f.read()
-    try: return json.loads(content)
-    except:
-        content = re.sub(r'[\x00-\x1f\x7f]', ' ', content)
-        content = re.sub(
-            r'("explanation_text"\s*:\s*")(.*?)("\s*[,}])', 
-            lambda m: m.group(1) + m.group(2).replace('"', '\\"') + m.group(3), 
-            content, flags=re.DOTALL
-        )
-        try: return json.loads(content)
-        except: raise ValueError("❌ JSON Error")
+    with open(file_path, 'rb') as f: raw = f.read()
+    try: return orjson.loads(raw)
+    except orjson.JSONDecodeError: pass
 
-def render_batch(video_path, segments, batch_index, total_batches, temp_dir, shared_state):
-    if shared_state.get('stop_signal', False): return None
-    shared_state['text'] = f"🔨 **Preparing Batch {batch_index}/{total_batches}...**"
-    shared_state['percent'] = 0
-    
-    processed_clips = []
-    original_video = VideoFileClip(video_path)
-    
+    # Raw newlines/tabs inside strings are the usual breakage; translate() is a single C pass
+    # (control bytes never occur inside UTF-8 multibyte sequences, so this is safe on bytes)
+    data = raw.translate(_CONTROL_TABLE)
+    try: return orjson.loads(data)
+    except orjson.JSONDecodeError: pass
+
+    data = _EXPL_RE.sub(lambda m: m.group(1) + m.group(2).replace(b'"', b'\\"') + m.group(3), data)
+    try: return orjson.loads(data)
+    except orjson.JSONDecodeError: raise ValueError("❌ JSON Error")
+
+# --- FFMPEG SEGMENT RENDERING ---
+# Cuts up to 2s at 24fps are looped from memory (~150MB of raw 1080p); longer ones are re-read instead
+LOOP_BUFFER_FRAMES = 48
+
+# ffmpeg opens and primes a decoder for every input up front and keeps them all alive,
+# so memory grows with the input count (~60MB per input at 720p, OOM past ~100 inputs).
+# MAX_GRAPH_INPUTS is the budget per job: maps within it render straight into the final
+# encode; bigger ones render bounded batches into parts that are then concatenated.
+MAX_GRAPH_INPUTS = int(os.getenv("MAX_GRAPH_INPUTS", "24"))
+RENDER_BATCH_SIZE = int(os.getenv("RENDER_BATCH_SIZE", "8"))
+# Batches render as parallel ffmpeg processes; threads are split so they don't oversubscribe cores
+CPU_COUNT = os.cpu_count() or 1
+RENDER_WORKERS = max(1, int(os.getenv("RENDER_WORKERS", str(min(2, CPU_COUNT)))))
+RENDER_THREADS = max(1, CPU_COUNT // RENDER_WORKERS)
+# The job budget is shared by the batches running side by side (5 is the smallest a split long loop needs)
+BATCH_INPUTS = max(5, MAX_GRAPH_INPUTS // RENDER_WORKERS)
+
+# Hardware encoders, tried in order: (name, global args, upload filter, encoder args).
+# HEVC serves the final encode, H.264 the intermediate batch parts
+HW_ENCODERS = (
+    ("hevc_nvenc", [], None, ["-c:v", "hevc_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "28"]),
+    ("hevc_qsv", [], None, ["-c:v", "hevc_qsv", "-preset", "veryfast", "-global_quality", "25"]),
+    ("hevc_vaapi", ["-vaapi_device", "/dev/dri/renderD128"], "format=nv12,hwupload", ["-c:v", "hevc_vaapi", "-qp", "25"]),
+)
+PART_HW_ENCODERS = (
+    ("h264_nvenc", [], None, ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ll", "-rc", "vbr", "-cq", "23"]),
+    ("h264_qsv", [], None, ["-c:v", "h264_qsv", "-preset", "veryfast"]),
+    ("h264_vaapi", ["-vaapi_device", "/dev/dri/renderD128"], "format=nv12,hwupload", ["-c:v", "h264_vaapi", "-qp", "23"]),
+)
+
+def _probe_hw_encoder(candidates):
+    """
+    Picks the first hardware encoder that can really open a session here;
+    being listed in `ffmpeg -encoders` only means it was compiled in.
+    HW_ENCODER=none forces software encoding, HW_ENCODER=<name> (e.g. hevc_nvenc)
+    or <backend> (e.g. nvenc) tries just the matching one.
+    """
+    wanted = os.getenv("HW_ENCODER", "auto")
+    if wanted == "none": return None
+    for name, global_args, upload, enc_args in candidates:
+        if wanted not in ("auto", name, name.split("_", 1)[1]): continue
+        probe = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", *global_args,
+            "-f", "lavfi", "-i", "color=s=256x256:d=0.2", *(["-vf", upload] if upload else []),
+            *enc_args, "-f", "null", "-"
+        ]
+        try:
+            if subprocess.run(probe, capture_output=True, timeout=15).returncode == 0:
+                return name, global_args, upload, enc_args
+        except FileNotFoundError:
+            return None  # No ffmpeg at all, nothing else will work either
+        except (OSError, subprocess.SubprocessError):
+            continue  # A hung or broken driver only rules out this encoder
+    return None
+
+HW_ENCODER = _probe_hw_encoder(HW_ENCODERS)
+PART_HW_ENCODER = _probe_hw_encoder(PART_HW_ENCODERS)
+print(f"🎛️ Video encoder: {HW_ENCODER[0] if HW_ENCODER else 'libx265'}, parts: {PART_HW_ENCODER[0] if PART_HW_ENCODER else 'libx264'}")
+
+FINAL_VIDEO_ARGS = HW_ENCODER[3] if HW_ENCODER else ["-c:v", "libx265", "-crf", "25", "-preset", "veryfast"]
+FINAL_ENCODE_ARGS = FINAL_VIDEO_ARGS + ["-c:a", "aac", "-b:a", "128k", "-tag:v", "hvc1"]
+
+# Every part uses the same profile so the concat demuxer can join them
+PART_VIDEO_ARGS = PART_HW_ENCODER[3] if PART_HW_ENCODER else ["-c:v", "libx264", "-preset", "ultrafast", "-threads", str(RENDER_THREADS)]
+PART_ENCODE_ARGS = PART_VIDEO_ARGS + ["-c:a", "aac", "-ar", "44100", "-ac", "2"]
+
+async def run_ffmpeg(args, shared_state=None):
+    """
+    Runs an FFmpeg job without progress parsing. Returns True on success.
+    Raises "Stop" when shared_state.stop_signal is set; ffmpeg is killed on stop
+    or cancellation, since cancelling communicate() alone leaves it running.
+    """
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error", *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    comm = asyncio.ensure_future(process.communicate())
     try:
-        for i, seg in enumerate(segments):
-            if shared_state.get('stop_signal', False): raise Exception("Stop")
-            audio_path = f"{temp_dir}/audio_{seg.get('id', f'b{batch_index}_{i}')}.wav"
-            if not os.path.exists(audio_path): continue
-            
-            try:
-                audio_clip = AudioFileClip(audio_path)
-                start_t = parse_time(seg.get('start_time', '0:00'))
-                end_t = parse_time(seg.get('end_time', '0:00'))
-                
-                if start_t >= end_t: audio_clip.close(); continue
-                video_chunk = original_video.subclipped(start_t, end_t)
-                
-                if video_chunk.duration < 0.1: 
-                    video_chunk.close(); audio_clip.close(); continue
-
-                ratio = audio_clip.duration / video_chunk.duration
-                final_chunk = None
-
-                if ratio > 1.0:
-                    if ratio > 1.5:
-                        loop_count = int(ratio) + 1
-                        video_chunk = video_chunk.with_effects([vfx.Loop(n=loop_count)])
-                        final_chunk = video_chunk.subclipped(0, audio_clip.duration)
-                    else:
-                        final_chunk = video_chunk.with_effects([vfx.MultiplySpeed(1/ratio)])
-                else:
-                    final_chunk = video_chunk.subclipped(0, audio_clip.duration)
-
-                final_chunk = final_chunk.with_audio(audio_clip)
-                processed_clips.append(final_chunk)
-            except: pass
-
-        if not processed_clips:
-            original_video.close()
-            return None
-
-        batch_output = os.path.abspath(f"{temp_dir}/batch_{batch_index}.mp4")
-        tg_logger = TelegramLogger(shared_state, batch_index, total_batches)
-
-        final_video = concatenate_videoclips(processed_clips, method="compose")
-        final_video.write_videofile(
-            batch_output, codec="libx264", audio_codec="aac", fps=24, preset='ultrafast', threads=4, logger=tg_logger 
+        while not comm.done():
+            await asyncio.wait({comm}, timeout=1)
+            if shared_state and shared_state.stop_signal: raise Exception("Stop")
+        _, stderr = comm.result()
+    except BaseException:
+        if process.returncode is None: process.kill()
+        comm.cancel()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        print(f"⚠️ FFmpeg Failed: {stderr.decode('utf-8', errors='ignore').strip()[-500:]}")
+        return False
+    return True
+
+def get_audio_duration(path):
+    # Sarvam returns WAV, so the header alone gives the length
+    with wave.open(path, 'rb') as w:
+        return w.getnframes() / float(w.getframerate())
+
+def build_segment_table(segments, temp_dir):
+    """
+    Flattens the map once into (label, audio_path, text, start_t, end_t) rows,
+    so the audio and render phases share the parsed times and paths.
+    """
+    table = []
+    for i, seg in enumerate(segments):
+        label = seg.get('id', i)
+        table.append((
+            label, f"{temp_dir}/audio_{label}.wav", seg.get('explanation_text', ''),
+            parse_time(seg.get('start_time', '0:00')), parse_time(seg.get('end_time', '0:00'))
+        ))
+    return table
+
+def plan_segment(start_t, end_t, audio_path):
+    """
+    Works out how a segment fits its narration: trimmed if the audio is shorter,
+    slowed down up to 1.5x, looped beyond that.
+    Returns (start_t, video_dur, audio_dur, audio_path, audio_start), or None to skip it.
+    """
+    video_dur = end_t - start_t
+    if video_dur < 0.1: return None
+
+    try: audio_dur = get_audio_duration(audio_path)
+    except (wave.Error, EOFError, OSError): return None
+    if audio_dur <= 0: return None
+    return start_t, video_dur, audio_dur, audio_path, 0.0
+
+def split_plan(plan, budget):
+    """
+    Splits a long loop that needs more than `budget` inputs into consecutive plans,
+    each looping the same cut over the next whole-loop slice of the narration.
+    """
+    if plan_inputs(plan) <= budget: return [plan]
+    start_t, video_dur, audio_dur, audio_path, audio_start = plan
+    step = (budget - 3) * video_dur  # int(ratio) + 2 inputs with ratio = budget - 3
+    pieces, offset = [], 0.0
+    # A tail under 1.5 loops would be slowed down instead of looped, so it joins the last piece
+    while audio_dur - offset > step + 1.5 * video_dur:
+        pieces.append((start_t, video_dur, step, audio_path, audio_start + offset))
+        offset += step
+    pieces.append((start_t, video_dur, audio_dur - offset, audio_path, audio_start + offset))
+    return pieces
+
+def plan_inputs(plan):
+    """Number of inputs build_filter_graph opens for a plan: its cut(s) plus the narration."""
+    video_dur, audio_dur = plan[1], plan[2]
+    ratio = audio_dur / video_dur
+    if ratio > 1.5 and math.ceil(video_dur * 24) > LOOP_BUFFER_FRAMES: return int(ratio) + 2
+    return 2
+
+def batch_plans(plans):
+    """Splits plans (in map order) into batches within BATCH_INPUTS and RENDER_BATCH_SIZE."""
+    batches, current, used = [], [], 0
+    for plan in plans:
+        n = plan_inputs(plan)
+        if current and (used + n > BATCH_INPUTS or len(current) >= RENDER_BATCH_SIZE):
+            batches.append(current)
+            current, used = [], 0
+        current.append(plan)
+        used += n
+    if current: batches.append(current)
+    return batches
+
+def build_filter_graph(video_path, plans):
+    """
+    Returns (input_args, filter_graph) rendering the given plans in one
+    ffmpeg run. Each cut is its own -ss/-t input so only the needed ranges are
+    decoded; the retimed cuts and their narrations are joined by one concat.
+    """
+    inputs, chains, pairs = [], [], []
+
+    def add_input(*args):
+        inputs.append(args)
+        return len(inputs) - 1
+
+    def add_cut(start_t, dur):
+        # Every cut's decoder stays alive for the whole run (see MAX_GRAPH_INPUTS);
+        # one thread each at least trims the per-input thread and frame-buffer cost
+        return add_input("-threads", "1", "-ss", f"{start_t:.3f}", "-t", f"{dur:.3f}", "-i", video_path)
+
+    for k, (start_t, video_dur, audio_dur, audio_path, audio_start) in enumerate(plans):
+        ratio = audio_dur / video_dur
+        if ratio > 1.5 and math.ceil(video_dur * 24) <= LOOP_BUFFER_FRAMES:
+            # Short loop: decode the cut once and replay its buffered frames
+            loops = int(ratio) + 1
+            i = add_cut(start_t, video_dur)
+            video = f"[{i}:v]setpts=PTS-STARTPTS,fps=24,loop=loop={loops - 1}:size={math.ceil(video_dur * 24)}:start=0"
+        elif ratio > 1.5:
+            # Long loop: the same cut int(ratio)+1 times through a nested concat (no frame buffer)
+            loops = int(ratio) + 1
+            ids = [add_cut(start_t, video_dur) for _ in range(loops)]
+            video = "".join(f"[{i}:v]" for i in ids) + f"concat=n={loops}:v=1:a=0,setpts=PTS-STARTPTS"
+        elif ratio > 1.0:
+            # Slow down: stretch the timestamps so the cut lasts as long as the audio
+            i = add_cut(start_t, video_dur)
+            video = f"[{i}:v]setpts={ratio:.6f}*(PTS-STARTPTS)"
+        else:
+            # Audio is shorter: only the first audio_dur seconds of the cut are read
+            i = add_cut(start_t, audio_dur)
+            video = f"[{i}:v]setpts=PTS-STARTPTS"
+        a = add_input("-i", audio_path)
+
+        # Clone-pad then trim: a cut that runs short (end past EOF) can't pull the later segments out of sync
+        chains.append(f"{video},fps=24,format=yuv420p,setsar=1,tpad=stop=-1:stop_mode=clone,trim=duration={audio_dur:.3f}[v{k}]")
+        chains.append(
+            f"[{a}:a]aformat=sample_rates=44100:channel_layouts=stereo,"
+            f"atrim=start={audio_start:.3f}:duration={audio_dur:.3f},asetpts=PTS-STARTPTS[a{k}]"
         )
-        
-        final_video.close()
-        for c in processed_clips: c.close()
-        original_video.close()
-        gc.collect()
-        return batch_output
+        pairs.append(f"[v{k}][a{k}]")
+
+    chains.append("".join(pairs) + f"concat=n={len(plans)}:v=1:a=1[v][a]")
+    return [arg for args in inputs for arg in args], ";".join(chains)
+
+async def gather_or_cancel(coros):
+    """
+    gather() that cancels the siblings as soon as one fails (e.g. Stop) and waits
+    for them to unwind (run_ffmpeg kills its process on cancel), so none of them
+    keep running after the temp dir is removed. Re-raises the original error.
+    """
+    tasks = [asyncio.create_task(c) for c in coros]
+    try: await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
-    except:
-        original_video.close()
-        return None
+async def render_batch(video_path, plans, out_path, shared_state=None):
+    """Renders a batch of planned segments into one intermediate part."""
+    inputs, graph = build_filter_graph(video_path, plans)
+    video = "[v]"
+    if PART_HW_ENCODER:
+        inputs = PART_HW_ENCODER[1] + inputs
+        if PART_HW_ENCODER[2]:
+            graph += f";[v]{PART_HW_ENCODER[2]}[vhw]"
+            video = "[vhw]"
+    args = inputs + ["-filter_complex", graph, "-map", video, "-map", "[a]"] + PART_ENCODE_ARGS + [out_path]
+    return await run_ffmpeg(args, shared_state)
 
-async def process_video_task(video_path, map_path, output_path, status_callback, shared_state, task_id):
+async def process_video_task(video_path, map_source, output_path, status_callback, shared_state, task_id):
+    """map_source is either the map.json path or the already-parsed map."""
     await status_callback("📂 **Loading Resources...**")
     
-    segments = load_and_heal_json(map_path)
+    segments = map_source if isinstance(map_source, (list, dict)) else load_and_heal_json(map_source)
     if isinstance(segments, dict): segments = [segments]
     
     # --- FIX: UNIQUE TEMP DIR ---
@@ -213,79 +456,108 @@ async def process_video_task(video_path, map_path, output_path, status_callback,
     os.makedirs(temp_dir, exist_ok=True)
     
     try:
-        total = len(segments)
+        table = build_segment_table(segments, temp_dir)
+        total = len(table)
+        # One directory listing instead of a stat per segment in each phase (resumed jobs keep their audio)
+        existing = {entry.path for entry in os.scandir(temp_dir)}
         
-        # 1. AUDIO
-        for i, seg in enumerate(segments):
-            if shared_state.get('stop_signal', False): raise Exception("Stop")
-            if i % 5 == 0:
-                await status_callback(f"🎙️ **Generating Audio...**\n{make_progress_bar(i, total)}")
-            
-            audio_path = f"{temp_dir}/audio_{seg.get('id', i)}.wav"
-            if not os.path.exists(audio_path):
-                await asyncio.to_thread(generate_audio_sync, seg.get('explanation_text', ''), audio_path)
-
-        # 2. BATCHES
-        BATCH_SIZE = 10
-        total_batches = (total + BATCH_SIZE - 1) // BATCH_SIZE
-        batch_files = []
-        render_running = True
-
-        async def progress_monitor():
-            last_text = ""
-            while render_running:
-                if shared_state.get('stop_signal', False): break 
-                await asyncio.sleep(3)
-                percent = shared_state.get('percent', 0)
-                text_header = shared_state.get('text', "⏳ Starting Render...")
-                bar = make_progress_bar(percent, 100)
-                new_text = f"{text_header}\n{bar}"
-                if new_text != last_text:
-                    try: await status_callback(new_text)
-                    except: pass
-                    last_text = new_text
+        # 1. AUDIO (requests run concurrently over the shared keep-alive client, capped by a semaphore)
+        await status_callback(f"🎙️ **Generating Audio...**\n{make_progress_bar(0, total)}")
+        tts_sem = asyncio.Semaphore(TTS_CONCURRENCY)
+        audio_done = 0
 
-        monitor_task = asyncio.create_task(progress_monitor())
+        async def generate_one(client, label, audio_path, text, start_t, end_t):
+            nonlocal audio_done
+            # A cut the renderer would drop anyway isn't worth a TTS request; empty text never
+            # reaches the breaker, where a call without a request would count as a success
+            if end_t - start_t >= 0.1 and text and text.strip() and audio_path not in existing:
+                async with tts_sem:
+                    if shared_state.stop_signal: raise Exception("Stop")
+                    try:
+                        if await _tts_breaker.call(generate_audio, client, text, audio_path): existing.add(audio_path)
+                    except TTSError as e: print(f"⚠️ TTS failed for segment {label}: {e}")
+            audio_done += 1
+            if audio_done % 5 == 0:
+                await status_callback(f"🎙️ **Generating Audio...**\n{make_progress_bar(audio_done, total)}")
 
-        try:
-            for i in range(0, total, BATCH_SIZE):
-                if shared_state.get('stop_signal', False): raise Exception("Stop")
-                batch_segments = segments[i : i + BATCH_SIZE]
-                batch_idx = i // BATCH_SIZE + 1
-                batch_file = await asyncio.to_thread(render_batch, video_path, batch_segments, batch_idx, total_batches, temp_dir, shared_state)
-                if batch_file: batch_files.append(batch_file)
-        finally:
-            render_running = False
-            monitor_task.cancel()
-
-        if not batch_files: raise Exception("No video segments generated.")
-
-        # 3. RE-ENCODE WITH PROGRESS
-        await status_callback("🚀 **Final Compression (x265)...**\n(Reducing size...)")
-        
-        list_file_path = f"{temp_dir}/inputs.txt"
-        with open(list_file_path, "w") as f:
-            for path in batch_files: f.write(f"file '{path}'\n")
+        client = get_tts_client()
+        await gather_or_cancel(generate_one(client, *row) for row in table)
 
-        # Get Total Duration (Correctly)
-        total_duration = 0
-        try:
-            # Probe the concatenation file to get total length
-            cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", "-f", "concat", "-safe", "0", list_file_path]
-            process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            stdout, _ = await process.communicate()
-            total_duration = float(stdout.decode().strip())
-        except: 
-            total_duration = 1800 # Fallback: 30 mins dummy default
-
-        command = [
-            "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_file_path,
-            "-c:v", "libx265", "-crf", "25", "-preset", "veryfast",
-            "-c:a", "aac", "-b:a", "128k", "-tag:v", "hvc1", output_path
-        ]
-        
-        # Run with Custom Progress Parser
-        await run_ffmpeg_with_progress(command, total_duration, status_callback)
+        # 2. RENDER + RE-ENCODE WITH PROGRESS
+        # Small maps: one ffmpeg run whose filter graph cuts, retimes and joins every segment and
+        # feeds the final encoder directly. Large maps: bounded batches first (see MAX_GRAPH_INPUTS)
+        def plan_all():
+            plans = []
+            for _label, audio_path, _text, start_t, end_t in table:
+                if audio_path not in existing: continue
+                plan = plan_segment(start_t, end_t, audio_path)
+                if plan: plans.append(plan)
+            return plans
+
+        plans = await asyncio.to_thread(plan_all)
+        if not plans: raise Exception("No video segments generated.")
+        if shared_state.stop_signal: raise Exception("Stop")
+
+        global_args, upload = (HW_ENCODER[1], HW_ENCODER[2]) if HW_ENCODER else ([], None)
+
+        if sum(plan_inputs(plan) for plan in plans) <= MAX_GRAPH_INPUTS:
+            await status_callback("🚀 **Rendering + Final Compression (HEVC)...**\n(Reducing size...)")
+
+            inputs, graph = build_filter_graph(video_path, plans)
+            video = "[v]"
+            if upload:
+                graph += f";[v]{upload}[vhw]"
+                video = "[vhw]"
+
+            # The graph grows with the map, so it goes through a file instead of one huge argv entry
+            graph_path = f"{temp_dir}/graph.txt"
+            with open(graph_path, "w") as f: f.write(graph)
+
+            source_args = [*inputs, "-filter_complex_script", graph_path, "-map", video, "-map", "[a]"]
+            total_duration = sum(plan[2] for plan in plans)
+        else:
+            # Long loops over the per-batch budget are split so no single ffmpeg exceeds it
+            pieces = [piece for plan in plans for piece in split_plan(plan, BATCH_INPUTS)]
+            batches = batch_plans(pieces)
+            part_paths = [os.path.abspath(f"{temp_dir}/part_{b}.mp4") for b in range(len(batches))]
+            results = [False] * len(batches)
+            render_sem = asyncio.Semaphore(RENDER_WORKERS)
+            rendered = 0
+            last_update = 0
+            await status_callback(f"🎞️ **Rendering Segments...**\n{make_progress_bar(0, len(pieces))}")
+
+            async def render_one(b):
+                nonlocal rendered, last_update
+                async with render_sem:
+                    if shared_state.stop_signal: raise Exception("Stop")
+                    results[b] = await render_batch(video_path, batches[b], part_paths[b], shared_state)
+                rendered += len(batches[b])
+                now = time.time()
+                if now - last_update > 4:
+                    last_update = now
+                    await status_callback(f"🎞️ **Rendering Segments...**\n{make_progress_bar(rendered, len(pieces))}")
+
+            # Batches start in source-time order so the seeks walk forward through the input;
+            # the parts are still joined in map order
+            order = sorted(range(len(batches)), key=lambda b: batches[b][0][0])
+            await gather_or_cancel(render_one(b) for b in order)
+
+            parts = [b for b in range(len(batches)) if results[b]]
+            if not parts: raise Exception("No video segments generated.")
+            if shared_state.stop_signal: raise Exception("Stop")
+
+            await status_callback("🚀 **Final Compression (HEVC)...**\n(Reducing size...)")
+            list_file_path = f"{temp_dir}/inputs.txt"
+            # Concat demuxer quoting: a ' inside the path is closed, escaped and reopened
+            with open(list_file_path, "w") as f:
+                f.write("".join("file '" + part_paths[b].replace("'", "'\\''") + "'\n" for b in parts))
+
+            source_args = ["-f", "concat", "-safe", "0", "-i", list_file_path, *(["-vf", upload] if upload else [])]
+            total_duration = sum(plan[2] for b in parts for plan in batches[b])
+
+        # Output length is known exactly (it follows the audio), so no ffprobe pass here
+        command = ["ffmpeg", "-y", *global_args, *source_args, *FINAL_ENCODE_ARGS, output_path]
+        await run_ffmpeg_with_progress(command, total_duration, status_callback, shared_state)
 
     finally:
         # --- FIX: DELETE TEMP DIR ---
@@ -1,16 +1,79 @@
+import os
 import time
 import math
+import mmap
+import asyncio
+import queue
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 
-async def progress_bar(current, total, status_text, start_time, status_msg):
+@dataclass(slots=True)
+class SharedState:
+    """Per-task state shared between the worker, /stopall and the processor."""
+    stop_signal: bool = False
+
+class EditThrottle:
+    """
+    Stands in for a status Message: edit() calls within `interval` seconds
+    collapse into one Telegram request carrying only the newest text, and
+    repeats of the text already shown are dropped.
+    Pass now=True for final states that must land immediately.
+    """
+    def __init__(self, msg, interval=4):
+        self.msg = msg
+        self.interval = interval
+        self.text = msg.text or ""  # Last text Telegram actually has
+        self._pending = None
+        self._task = None
+        self._last_sent = 0.0
+
+    async def edit(self, text, now=False):
+        if now:
+            self._cancel()
+            await self._send(text)
+            return
+        self._pending = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._runner())
+
+    async def delete(self):
+        self._cancel()
+        await self.msg.delete()
+
+    async def _runner(self):
+        try:
+            while self._pending is not None:
+                delay = self._last_sent + self.interval - time.time()
+                if delay > 0: await asyncio.sleep(delay)
+                text, self._pending = self._pending, None
+                try: await self._send(text)
+                except Exception: pass
+        finally:
+            self._task = None
+
+    async def _send(self, text):
+        if text == self.text: return
+        self._last_sent = time.time()
+        await self.msg.edit(text)
+        self.text = text
+
+    def _cancel(self):
+        self._pending = None
+        if self._task: self._task.cancel()
+        self._task = None
+
+async def progress_bar(current, total, status_text, start_time, status_msg, force=False):
     """
     Updates the Telegram message with a progress bar.
     Signature matches Pyrogram's progress_callback expectation but adds status_msg.
+    Pass force=True when the caller already throttles its own updates.
     """
     now = time.time()
     diff = now - start_time
     
     # Update only every 5 seconds or if complete to avoid FloodWait
-    if round(diff % 5.00) == 0 or current == total:
+    if force or round(diff % 5.00) == 0 or current == total:
         percentage = current * 100 / total
         speed = current / diff if diff > 0 else 0
         elapsed_time = round(diff) * 1000
@@ -41,6 +104,34 @@ async def progress_bar(current, total, status_text, start_time, status_msg):
         except Exception:
             pass 
 
+def new_progress(total=0):
+    """Counter shared by a transfer loop and its progress_updater."""
+    return {'done': 0, 'total': total, 'event': asyncio.Event()}
+
+async def progress_updater(progress, status_text, status_msg, start_time, interval=3):
+    """
+    Background task that renders the byte counter at most every `interval` seconds.
+    The transfer loop bumps progress['done'] and sets progress['event']; the task
+    sleeps on that event, so a stalled transfer costs no wakeups or edits.
+    Set progress['finished'] to stop.
+    """
+    event = progress['event']
+    while not progress.get('finished'):
+        await event.wait()
+        event.clear()
+        if progress['total'] > 0 and not progress.get('finished'):
+            await progress_bar(progress['done'], progress['total'], status_text, start_time, status_msg, force=True)
+        await asyncio.sleep(interval)  # Debounce: later bumps coalesce into the next update
+
+async def track_progress(current, total, progress):
+    """
+    Pyrogram progress callback that only records the counters for progress_updater.
+    Kept async on purpose: Pyrogram runs sync callbacks through a thread executor.
+    """
+    progress['done'] = current
+    progress['total'] = total
+    progress['event'].set()
+
 def humanbytes(size):
     if not size: return ""
     power = 2**10
@@ -61,3 +152,129 @@ def time_formatter(milliseconds: int) -> str:
         ((str(minutes) + "m, ") if minutes else "") + \
         ((str(seconds) + "s, ") if seconds else "") 
     return tmp[:-2] if tmp else "0s"
+
+class SessionStore(OrderedDict):
+    """
+    LRU-bounded dict for per-user conversation state.
+    Reads and writes mark an entry as recently used; past maxsize the oldest is evicted.
+    """
+    def __init__(self, maxsize=1024):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self: return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+# --- BATCHED FILE WRITER ---
+def _write_all(fd, data):
+    """Writes one buffer completely, resuming after short writes."""
+    while data: data = data[os.write(fd, data):]
+
+def _settle(future, error):
+    if future.cancelled(): return
+    if error is None: future.set_result(None)
+    else: future.set_exception(error)
+
+class BatchedFileWriter:
+    """
+    Download sink that copies incoming chunks into a fixed pool of
+    batch_size buffers and writes each full buffer with a single write()
+    on its own writer thread.
+    The pool (max_inflight + 1 anonymous mmaps) is allocated once per file
+    and recycled, so the hot path allocates nothing and at most
+    max_inflight buffers queue up for the disk while the next one fills.
+    Nothing is synced per write or on close; the page cache coalesces the
+    writes.
+    """
+    def __init__(self, path, batch_size=8 * 1024 * 1024, preallocate=0, max_inflight=2):
+        # O_TRUNC replaces any stale file, no exists()/remove() round trip needed
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.batch_size = batch_size
+        if preallocate > 0 and hasattr(os, "posix_fallocate"):
+            # Reserve contiguous extents up front; ffmpeg reads this file sequentially later
+            try: os.posix_fallocate(self.fd, 0, preallocate)
+            except OSError: pass
+
+        # Page-aligned, lazily faulted in by the kernel; reused for every batch
+        self._free = deque(mmap.mmap(-1, batch_size) for _ in range(max_inflight + 1))
+        self._buf = self._free.popleft()
+        self._fill = 0
+
+        self._loop = asyncio.get_running_loop()
+        self._ops = queue.Queue()
+        self._inflight = deque()
+        threading.Thread(target=self._run, name="file-writer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            op = self._ops.get()
+            if op is None: return
+            buf, size, future = op
+            try:
+                _write_all(self.fd, memoryview(buf)[:size])
+                error = None
+            except OSError as e:
+                error = e
+            self._loop.call_soon_threadsafe(_settle, future, error)
+
+    async def write(self, chunk):
+        view = memoryview(chunk)
+        while view:
+            n = min(len(view), self.batch_size - self._fill)
+            self._buf[self._fill:self._fill + n] = view[:n]
+            self._fill += n
+            view = view[n:]
+            if self._fill == self.batch_size:
+                await self.flush()
+
+    async def _reclaim(self):
+        future, buf = self._inflight.popleft()
+        try: await future
+        finally: self._free.append(buf)
+
+    async def flush(self):
+        if not self._fill: return
+        future = self._loop.create_future()
+        self._inflight.append((future, self._buf))
+        self._ops.put((self._buf, self._fill, future))
+        # Backpressure: the network can't run more than the pool ahead of the disk
+        while not self._free:
+            await self._reclaim()
+        self._buf = self._free.popleft()
+        self._fill = 0
+
+    async def _drain(self, suppress=False):
+        while self._inflight:
+            try: await self._reclaim()
+            except OSError:
+                if not suppress: raise
+
+    async def close(self):
+        try:
+            await self.flush()
+            await self._drain()
+        finally:
+            self._ops.put(None)
+            os.close(self.fd)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+            return
+        # Aborted download, the partial file gets cleaned up anyway; just never
+        # close the fd under a write that is still running in the thread
+        try: await self._drain(suppress=True)
+        finally:
+            self._ops.put(None)
+            os.close(self.fd)